@@ -1,127 +1,509 @@
-import json
+import asyncio
+import functools
+import hashlib
 import logging
-from typing import List, Optional
+import os
+import sqlite3
+from dataclasses import dataclass, field
+from typing import AbstractSet, Any, Awaitable, Callable, Dict, List, Optional, TypeVar
 
+import diskcache
 import httpx
+import msgspec
+import orjson
+import platformdirs
+from aiolimiter import AsyncLimiter
+from tenacity import (
+    RetryCallState,
+    retry,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+logger = logging.getLogger(__name__)
+
+# Current base url for the Hubspot API, shared by every request made through the client.
+HUBSPOT_BASE_URL = "https://api.hubapi.com"
+
+# Paths for companies and company-to-company associations in the Hubspot CRM.
+COMPANIES_PATH = "/crm/v3/objects/companies"
+COMPANY_ASSOCIATIONS_PATH = "/crm/v4/associations/companies/companies/batch/create"
+
+# Maximum number of results Hubspot returns per page of a search request, and in total across all pages.
+SEARCH_PAGE_LIMIT = 100
+SEARCH_RESULT_LIMIT = 10_000
+
+# Maximum number of inputs sent in a single association batch request.
+ASSOCIATION_BATCH_LIMIT = 100
+
+# Created parent company IDs are cached on disk for a short time, as Hubspot's search index can take a while to
+# include a new company. A rerun in that window reads the company by ID rather than creating a duplicate.
+PARENT_COMPANY_CACHE_DIR = os.path.join(
+    platformdirs.user_cache_dir("h-and-d-test-1"), "parent-companies"
+)
+PARENT_COMPANY_CACHE_TTL_SECONDS = 5 * 60
+
+# Errors raised by an unwritable or corrupt cache directory. The cache is only an aid, so these never fail a run.
+CACHE_ERRORS = (OSError, sqlite3.Error, diskcache.Timeout)
+
+
+@functools.lru_cache(maxsize=None)
+def _parent_company_cache() -> Optional[diskcache.Cache]:
+    # Opened on first use rather than at import. The directory is kept private to the user,
+    # as diskcache will unpickle whatever it finds there.
+    # If it can't be opened, None is cached instead, so the warning is only logged once and lookups go uncached.
+    try:
+        os.makedirs(PARENT_COMPANY_CACHE_DIR, mode=0o700, exist_ok=True)
+        os.chmod(PARENT_COMPANY_CACHE_DIR, 0o700)
+        return diskcache.Cache(PARENT_COMPANY_CACHE_DIR)
+    except CACHE_ERRORS as error:
+        logger.warning(
+            "Parent company cache at %s is unavailable, continuing without it: %s",
+            PARENT_COMPANY_CACHE_DIR,
+            error,
+        )
+        return None
+
+
+# Hubspot rate limits API requests, so requests are capped at 9 in flight and 9 per 5 seconds.
+# This stays clear of 429 responses, which cost more time in retries than they save.
+MAX_CONCURRENT_REQUESTS = 9
+RATE_LIMIT_PERIOD_SECONDS = 5
+
+# Rate limiting and transient server errors are retried with backoff rather than aborting the run.
+# A 429 means Hubspot refused the request without acting on it, so it is always safe to retry.
+# A server error may arrive after Hubspot has already acted, so it is only retried for idempotent requests.
+RATE_LIMITED_STATUS_CODE = 429
+SERVER_ERROR_STATUS_CODES = frozenset({500, 502, 503, 504})
+MAX_REQUEST_ATTEMPTS = 6
+
+# Longest wait between attempts, for both the backoff and a "Retry-After" header asking for longer.
+MAX_RETRY_WAIT_SECONDS = 30
+
+_exponential_backoff = wait_exponential_jitter(initial=0.5, max=MAX_RETRY_WAIT_SECONDS)
+
+
+T = TypeVar("T")
+
+
+@dataclass(eq=False)
+class HubspotSession:
+    # State shared by every request in a run: the client and the concurrency and rate limits its requests wait on.
+    # The limits are created with the session rather than at import, as they bind to the event loop they are first used on.
+    # Child and parent company lookups are memoised for the session's lifetime, keyed by ID, so processing a batch of
+    # parent IDs with one session only looks each group up once.
+    client: httpx.AsyncClient
+    semaphore: asyncio.Semaphore = field(
+        default_factory=lambda: asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    )
+    limiter: AsyncLimiter = field(
+        default_factory=lambda: AsyncLimiter(
+            MAX_CONCURRENT_REQUESTS, RATE_LIMIT_PERIOD_SECONDS
+        )
+    )
+    child_company_lookups: Dict[str, "asyncio.Task[List[Dict[str, Any]]]"] = field(
+        default_factory=dict
+    )
+    parent_company_lookups: Dict[str, "asyncio.Task[Optional[Dict[str, Any]]]"] = field(
+        default_factory=dict
+    )
+
+    @functools.cached_property
+    def account_key(self) -> str:
+        # A hash of the client's access token, identifying the Hubspot account without storing the token itself.
+        authorization = self.client.headers.get("Authorization", "")
+        return hashlib.sha256(authorization.encode()).hexdigest()
+
+
+async def _memoised(
+    lookups: Dict[str, "asyncio.Task[T]"], key: str, lookup: Callable[[], Awaitable[T]]
+) -> T:
+    # Run a lookup once per key, sharing the result (or the in-flight request) with every caller asking for the same key.
+    task = lookups.get(key)
+    if task is None:
+        task = asyncio.ensure_future(lookup())
+        lookups[key] = task
+
+    try:
+        # Shielded so one caller being cancelled doesn't cancel the lookup for the others.
+        return await asyncio.shield(task)
+    except Exception:
+        # Failed lookups aren't memoised, so a later call can try again.
+        if lookups.get(key) is task:
+            del lookups[key]
+        raise
+
+
+def _should_retry(retry_state: RetryCallState) -> bool:
+    exception = retry_state.outcome.exception() if retry_state.outcome else None
+    if not isinstance(exception, httpx.HTTPStatusError):
+        return False
+
+    status_code = exception.response.status_code
+    if status_code == RATE_LIMITED_STATUS_CODE:
+        return True
+    return status_code in SERVER_ERROR_STATUS_CODES and retry_state.kwargs.get(
+        "idempotent", True
+    )
+
+
+def _wait_before_retry(retry_state: RetryCallState) -> float:
+    # Honour the "Retry-After" header Hubspot sends with 429 responses, otherwise back off exponentially with jitter.
+    exception = retry_state.outcome.exception() if retry_state.outcome else None
+    if (
+        isinstance(exception, httpx.HTTPStatusError)
+        and exception.response.status_code == RATE_LIMITED_STATUS_CODE
+    ):
+        try:
+            retry_after = float(exception.response.headers["Retry-After"])
+            return min(max(retry_after, 0), MAX_RETRY_WAIT_SECONDS)
+        except (KeyError, ValueError):
+            pass
+    return _exponential_backoff(retry_state)
+
+
+@retry(
+    retry=_should_retry,
+    wait=_wait_before_retry,
+    stop=stop_after_attempt(MAX_REQUEST_ATTEMPTS),
+    reraise=True,
+)
+async def _request(
+    session: HubspotSession,
+    method: str,
+    url: str,
+    *,
+    idempotent: bool = True,
+    expected_statuses: AbstractSet[int] = frozenset(),
+    **kwargs: Any,
+) -> httpx.Response:
+    # Send a request through the session's client, waiting for a free slot under its concurrency and rate limits.
+    # Requests that would repeat their effect if sent twice must pass idempotent=False to skip server error retries.
+    # Error statuses the caller handles itself are passed in expected_statuses, so they aren't logged as failures.
+    # The slot is released before any retry backoff, so waiting requests aren't held up by it.
+    async with session.semaphore, session.limiter:
+        response = await session.client.request(method, url, **kwargs)
+
+    # Any error status raises httpx.HTTPStatusError, but only the retryable ones are tried again (see _should_retry).
+    # Hubspot explains the failure in the body, which the exception itself doesn't include.
+    if not response.is_success:
+        expected = response.status_code in expected_statuses
+        logger.log(
+            logging.DEBUG if expected else logging.WARNING,
+            "Hubspot request %s %s failed with status %s: %s",
+            method,
+            url,
+            response.status_code,
+            response.text,
+        )
+        response.raise_for_status()
+
+    return response
+
+
+def _log_response(message: str, response: httpx.Response, *args: Any) -> None:
+    # Log the JSON body exactly as Hubspot returned it, only decoding it to text when debug logging is enabled.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message + ": %s", *args, response.text)
+
+
+# Request payloads are msgspec structs, encoded straight to bytes rather than built as nested dicts for httpx to serialise.
+# Field names are camel-cased on encoding to match the Hubspot API, and unset optional fields are left out.
+class SearchFilter(msgspec.Struct, rename="camel"):
+    property_name: str
+    value: str
+    operator: str = "EQ"
+
 
-# Current base url for companies in the Hubspot CRM.
-HUBSPOT_BASE_URL = "https://api.hubapi.com/crm/v3/objects/companies"
+class SearchFilterGroup(msgspec.Struct):
+    filters: List[SearchFilter]
 
 
-def fetch_child_companies(
-    parent_id: str, access_token: str, verbose: bool = False
-) -> List[dict]:
-    # Fetch all companies and filter for ones that have a "Client Parent Company ID" matching the given Location ID.
-    url = f"{HUBSPOT_BASE_URL}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    params = {"properties": "client_parent_company_id,name"}
+class SearchSort(msgspec.Struct, rename="camel"):
+    property_name: str
+    direction: str = "ASCENDING"
 
-    response = httpx.get(url, headers=headers, params=params)
 
-    if verbose:
-        print(
-            "\n[Verbose Mode] Fetching child companies with Client Parent Company ID:",
+class SearchPayload(msgspec.Struct, rename="camel", omit_defaults=True):
+    filter_groups: List[SearchFilterGroup]
+    properties: List[str]
+    sorts: List[SearchSort] = []
+    limit: Optional[int] = None
+    after: Optional[str] = None
+
+
+class PropertiesPayload(msgspec.Struct):
+    properties: Dict[str, str]
+
+
+class ObjectId(msgspec.Struct):
+    id: str
+
+
+class AssocInput(msgspec.Struct, rename="camel"):
+    from_: ObjectId = msgspec.field(name="from")
+    to: ObjectId
+    association_type_id: int
+    association_category: str = "HUBSPOT_DEFINED"
+
+
+class AssocBatchPayload(msgspec.Struct):
+    inputs: List[AssocInput]
+
+
+_json_encoder = msgspec.json.Encoder()
+
+
+async def fetch_child_companies(
+    parent_id: str, session: HubspotSession
+) -> List[Dict[str, Any]]:
+    return await _memoised(
+        session.child_company_lookups,
+        parent_id,
+        lambda: _search_child_companies(parent_id, session),
+    )
+
+
+async def _search_child_companies(
+    parent_id: str, session: HubspotSession
+) -> List[Dict[str, Any]]:
+    # Search for companies that have a "Client Parent Company ID" matching the given Location ID.
+    # Filtering server-side means only the children are transferred, rather than every company in the account.
+    search_payload = SearchPayload(
+        filter_groups=[
+            SearchFilterGroup(
+                filters=[
+                    SearchFilter(
+                        property_name="client_parent_company_id", value=parent_id
+                    )
+                ]
+            )
+        ],
+        # Only the name is needed, to name a new parent company if one has to be created. The ID is always returned.
+        properties=["name"],
+        # Sorting on the object ID keeps the page order stable while the cursor is followed.
+        sorts=[SearchSort(property_name="hs_object_id")],
+        limit=SEARCH_PAGE_LIMIT,
+    )
+
+    child_companies: List[Dict[str, Any]] = []
+
+    # Follow the paging cursor until Hubspot stops returning one.
+    while True:
+        response = await _request(
+            session,
+            "POST",
+            f"{COMPANIES_PATH}/search",
+            content=_json_encoder.encode(search_payload),
+        )
+
+        _log_response(
+            "Fetched child companies with Client Parent Company ID %s",
+            response,
             parent_id,
         )
-        print(json.dumps(response.json(), indent=2))
 
-    if response.status_code == 200:
-        companies = response.json().get("results", [])
-        return [
-            company
-            for company in companies
-            if company["properties"].get("client_parent_company_id") == parent_id
-        ]
+        data = orjson.loads(response.content)
 
-    raise Exception(f"Failed to fetch child companies: {response.text}")
+        # Hubspot refuses to page past its search result limit, so fail up front rather than part way through.
+        if data.get("total", 0) > SEARCH_RESULT_LIMIT:
+            raise ValueError(
+                f"Too many child companies found with Client Parent Company ID: {parent_id}. "
+                + f"Hubspot search returns at most {SEARCH_RESULT_LIMIT} results."
+            )
 
+        child_companies.extend(data.get("results", []))
 
-def fetch_parent_company(
-    location_id: str, access_token: str, verbose: bool = False
-) -> Optional[dict]:
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            return child_companies
+        search_payload.after = after
+
+
+async def fetch_parent_company(
+    location_id: str, session: HubspotSession
+) -> Optional[Dict[str, Any]]:
+    return await _memoised(
+        session.parent_company_lookups,
+        location_id,
+        lambda: _lookup_parent_company(location_id, session),
+    )
+
+
+async def _lookup_parent_company(
+    location_id: str, session: HubspotSession
+) -> Optional[Dict[str, Any]]:
     # Fetch the parent company using the "Client Company Location ID". There must be exactly one or zero results.
-    url = f"{HUBSPOT_BASE_URL}/search"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
+    # The search always runs, so that check applies even when the parent's ID is cached.
+    company = await _search_parent_company(location_id, session)
+    if company is not None:
+        return company
+
+    # No result may only mean the search index hasn't caught up with a parent created by a recent run.
+    # If one was, it is read by its cached ID instead of a second parent being created.
+    cached_company_id = _cached_parent_company_id(location_id, session)
+    if cached_company_id is None:
+        return None
+
+    company = await _read_parent_company(cached_company_id, location_id, session)
+    if company is None:
+        # The company has since been deleted or moved to another location, so forget it.
+        _forget_parent_company_id(location_id, session)
+    return company
+
+
+async def _read_parent_company(
+    company_id: str, location_id: str, session: HubspotSession
+) -> Optional[Dict[str, Any]]:
+    # Read a recently created parent company by ID, returning None if it no longer belongs to the given location.
+    try:
+        response = await _request(
+            session,
+            "GET",
+            f"{COMPANIES_PATH}/{company_id}",
+            params={"properties": "imported_company_name,client_company_location_id"},
+            expected_statuses={404},
+        )
+    except httpx.HTTPStatusError as error:
+        if error.response.status_code == 404:
+            return None
+        raise
+
+    _log_response("Read recently created parent company %s", response, company_id)
 
+    data: Dict[str, Any] = orjson.loads(response.content)
+
+    if data["properties"].get("client_company_location_id") != location_id:
+        return None
+    return data
+
+
+async def _search_parent_company(
+    location_id: str, session: HubspotSession
+) -> Optional[Dict[str, Any]]:
     # Create the search query to match the Client Company Location ID exactly
-    search_payload = {
-        "filterGroups": [
-            {
-                "filters": [
-                    {
-                        "propertyName": "client_company_location_id",
-                        "operator": "EQ",
-                        "value": location_id,
-                    }
+    search_payload = SearchPayload(
+        filter_groups=[
+            SearchFilterGroup(
+                filters=[
+                    SearchFilter(
+                        property_name="client_company_location_id", value=location_id
+                    )
                 ]
-            }
+            )
         ],
-        "properties": ["client_company_location_id", "name", "imported_company_name"],
-    }
+        # Only the imported name is needed, to update the parent company. The ID is always returned.
+        properties=["imported_company_name"],
+    )
 
-    response = httpx.post(url, headers=headers, json=search_payload, timeout=10.0)
+    response = await _request(
+        session,
+        "POST",
+        f"{COMPANIES_PATH}/search",
+        content=_json_encoder.encode(search_payload),
+    )
 
-    if verbose:
-        print(
-            "\n[Verbose Mode] Searching for parent company with Client Company Location ID:",
-            location_id,
+    _log_response(
+        "Searched for parent company with Client Company Location ID %s",
+        response,
+        location_id,
+    )
+
+    data = orjson.loads(response.content)
+
+    if data["total"] > 1:
+        raise ValueError(
+            f"Multiple companies found with Client Company Location ID: {location_id}. Expected only one or zero."
         )
-        print(json.dumps(response.json(), indent=2))
 
-    if response.status_code == 200:
-        companies = response.json().get("results", [])
+    companies: List[Dict[str, Any]] = data["results"]
+    return companies[0] if companies else None
 
-        if len(companies) > 1:
-            raise ValueError(
-                f"Multiple companies found with Client Company Location ID: {location_id}. Expected only one or zero."
-            )
 
-        return companies[0] if companies else None
+def _parent_company_cache_key(location_id: str, session: HubspotSession) -> str:
+    # Location IDs are only unique within a Hubspot account, so the key is scoped to the session's account.
+    return f"{session.account_key}:{location_id}"
 
-    raise Exception(f"Failed to fetch parent company: {response.text}")
 
+def _cached_parent_company_id(
+    location_id: str, session: HubspotSession
+) -> Optional[str]:
+    cache = _parent_company_cache()
+    if cache is None:
+        return None
 
-def update_parent_company(
-    company_id: str, imported_name: str, access_token: str, verbose: bool = False
-):
-    # Update the "Company Name" property of a parent company unless the "Imported Company Name" is empty.
-    if not imported_name.strip():
-        logging.warning(
-            f"[Warning] Imported Company Name is empty for company ID: {company_id}. Skipping update."
+    try:
+        company_id = cache.get(_parent_company_cache_key(location_id, session))
+    except CACHE_ERRORS as error:
+        logger.warning("Could not read parent company cache: %s", error)
+        return None
+    return company_id if isinstance(company_id, str) else None
+
+
+def _remember_parent_company_id(
+    location_id: str, company_id: str, session: HubspotSession
+) -> None:
+    cache = _parent_company_cache()
+    if cache is None:
+        return
+
+    try:
+        cache.set(
+            _parent_company_cache_key(location_id, session),
+            company_id,
+            expire=PARENT_COMPANY_CACHE_TTL_SECONDS,
         )
+    except CACHE_ERRORS as error:
+        logger.warning("Could not write parent company cache: %s", error)
+
+
+def _forget_parent_company_id(location_id: str, session: HubspotSession) -> None:
+    cache = _parent_company_cache()
+    if cache is None:
         return
 
-    url = f"{HUBSPOT_BASE_URL}/{company_id}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    update_data = {"properties": {"name": imported_name}}
+    try:
+        cache.delete(_parent_company_cache_key(location_id, session))
+    except CACHE_ERRORS as error:
+        logger.warning("Could not write parent company cache: %s", error)
 
-    response = httpx.patch(url, headers=headers, json=update_data, timeout=30.0)
 
-    if verbose:
-        print("\n[Verbose Mode] Updating company name to:", imported_name)
-        print(json.dumps(response.json(), indent=2))
+async def update_parent_company(
+    company_id: str,
+    imported_name: str,
+    session: HubspotSession,
+) -> Optional[Dict[str, Any]]:
+    # Update the "Company Name" property of a parent company unless the "Imported Company Name" is empty.
+    if not imported_name.strip():
+        logger.warning(
+            "Imported Company Name is empty for company ID: %s. Skipping update.",
+            company_id,
+        )
+        return None
 
-    if response.status_code != 200:
-        raise Exception(f"Failed to update parent company: {response.text}")
+    update_data = PropertiesPayload(properties={"name": imported_name})
 
-    return response.json()
+    response = await _request(
+        session,
+        "PATCH",
+        f"{COMPANIES_PATH}/{company_id}",
+        content=_json_encoder.encode(update_data),
+    )
 
+    # A successful update may come back as 204 with no body.
+    _log_response("Updated company name to %s", response, imported_name)
 
-def create_parent_company(
+    updated_company: Dict[str, Any] = (
+        orjson.loads(response.content) if response.content else {}
+    )
+    return updated_company
+
+
+async def create_parent_company(
     location_id: str,
-    child_companies: List[dict],
-    access_token: str,
-    verbose: bool = False,
-) -> dict:
+    child_companies: List[Dict[str, Any]],
+    session: HubspotSession,
+) -> Dict[str, Any]:
     # Create a new parent company for the given "Client Company Location ID".
     if not child_companies:
         raise ValueError(
@@ -134,103 +516,116 @@ def create_parent_company(
         child_companies[0]["properties"].get("name", "Unnamed Company") + " - Parent"
     )
 
-    url = f"{HUBSPOT_BASE_URL}"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    company_data = {
-        "properties": {"name": new_name, "client_company_location_id": location_id}
-    }
-
-    response = httpx.post(url, headers=headers, json=company_data, timeout=10.0)
-
-    if verbose:
-        print("\n[Verbose Mode] Creating parent company:", new_name)
-        print(json.dumps(response.json(), indent=2))
-
-    # 201 is returned if creation is successful.
-    if response.status_code == 201:
-        return response.json()
-
-    raise Exception(f"Failed to create parent company: {response.text}")
-
-
-def associate_child_to_parent(
-    child_id: str, parent_id: str, access_token: str, verbose: bool = False
-):
-    # Associate a child company with a parent company in Hubspot.
-
-    url = "https://api.hubapi.com/crm/v4/associations/companies/companies/batch/create"
-
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-
-    # Use Hubspot's predefined Parent-Child association (Type ID: 13 for Parent to Child, 14 for Child to Parent).
-    association_data = {
-        "inputs": [
-            {
-                "from": {"id": parent_id},
-                "to": {"id": child_id},
-                "associationCategory": "HUBSPOT_DEFINED",
-                "associationTypeId": 13,  # Parent to Child association
-            },
-            {
-                "from": {"id": child_id},
-                "to": {"id": parent_id},
-                "associationCategory": "HUBSPOT_DEFINED",
-                "associationTypeId": 14,  # Child to Parent association
-            },
-        ]
-    }
-
-    response = httpx.post(url, headers=headers, json=association_data, timeout=30)
-
-    if verbose:
-        print(
-            f"\n[Verbose Mode] Associating Child Company {child_id} to Parent Company {parent_id} (Labels: Parent & Child)"
+    company_data = PropertiesPayload(
+        properties={"name": new_name, "client_company_location_id": location_id}
+    )
+
+    # Creating a company isn't idempotent: a retry after a server error could create a duplicate parent.
+    response = await _request(
+        session,
+        "POST",
+        COMPANIES_PATH,
+        idempotent=False,
+        content=_json_encoder.encode(company_data),
+    )
+
+    _log_response("Created parent company %s", response, new_name)
+
+    created_company: Dict[str, Any] = orjson.loads(response.content)
+    return created_company
+
+
+async def associate_children_to_parent(
+    child_ids: List[str],
+    parent_id: str,
+    session: HubspotSession,
+) -> None:
+    # Associate child companies with a parent company in Hubspot, using as few batch requests as possible.
+    # Each child needs two inputs, so a request covers up to half the batch limit in children.
+    children_per_batch = ASSOCIATION_BATCH_LIMIT // 2
+    batches = [
+        child_ids[i : i + children_per_batch]
+        for i in range(0, len(child_ids), children_per_batch)
+    ]
+
+    async def associate_batch(batch: List[str]) -> None:
+        # Use Hubspot's predefined Parent-Child association (Type ID: 13 for Parent to Child, 14 for Child to Parent).
+        parent = ObjectId(id=parent_id)
+        inputs = []
+        for child_id in batch:
+            child = ObjectId(id=child_id)
+            # Parent to Child association
+            inputs.append(AssocInput(from_=parent, to=child, association_type_id=13))
+            # Child to Parent association
+            inputs.append(AssocInput(from_=child, to=parent, association_type_id=14))
+
+        response = await _request(
+            session,
+            "POST",
+            COMPANY_ASSOCIATIONS_PATH,
+            content=_json_encoder.encode(AssocBatchPayload(inputs=inputs)),
         )
-        print(f"Response Status: {response.status_code}")
-        print(f"Response Text: {response.text}")
 
-    # 201 is returned if association via. POST is successful.
-    if response.status_code == 201:
-        return
+        _log_response(
+            "Associated child companies %s to parent company %s (Labels: Parent & Child): %s",
+            response,
+            batch,
+            parent_id,
+            response.status_code,
+        )
 
-    # Log error and raise an exception.
-    error_message = f"Failed to associate child company {child_id} with parent company {parent_id}: {response.status_code} - {response.text}"
-    raise Exception(error_message)
+        # 207 is returned if only some of the associations in the batch were created.
+        if response.status_code != 207:
+            return
 
+        # Log error and raise an exception.
+        error_message = f"Failed to associate {len(batch)} child companies with parent company {parent_id}: {response.status_code} - {response.text}"
+        raise Exception(error_message)
 
-def process_companies(
-    client_company_location_id: str, access_token: str, verbose: bool = False
-):
-    # Main function to process and update or create companies in Hubspot.
+    # Batches are independent of each other, so they are sent concurrently.
+    await asyncio.gather(*(associate_batch(batch) for batch in batches))
 
-    # Fetch child companies.
-    child_companies = fetch_child_companies(
-        client_company_location_id, access_token, verbose
-    )
 
-    # Fetch or create the parent company.
-    parent_company = fetch_parent_company(
-        client_company_location_id, access_token, verbose
+async def process_companies(
+    client_company_location_id: str, session: HubspotSession
+) -> Dict[str, Any]:
+    # Main function to process and update or create companies in Hubspot.
+
+    # Fetch child companies and the parent company concurrently, as neither lookup depends on the other.
+    child_companies: List[Dict[str, Any]]
+    parent_company: Optional[Dict[str, Any]]
+    child_companies, parent_company = await asyncio.gather(
+        fetch_child_companies(client_company_location_id, session),
+        fetch_parent_company(client_company_location_id, session),
     )
 
+    # Update or create the parent company.
     if parent_company:
         parent_company_id = parent_company["id"]
         imported_name = parent_company["properties"].get("imported_company_name", "")
-        update_parent_company(parent_company_id, imported_name, access_token, verbose)
+        updated_company = await update_parent_company(
+            parent_company_id, imported_name, session
+        )
+
+        # The parent company has been renamed, so the memoised lookup of it is now stale.
+        if updated_company is not None:
+            session.parent_company_lookups.pop(client_company_location_id, None)
     else:
-        parent_company = create_parent_company(
-            client_company_location_id, child_companies, access_token, verbose
+        parent_company = await create_parent_company(
+            client_company_location_id, child_companies, session
         )
         parent_company_id = parent_company["id"]
 
+        # A parent company now exists for this location, so drop the memoised lookup and remember its ID.
+        # A rerun then finds it even if Hubspot's search index hasn't caught up with the new company yet.
+        session.parent_company_lookups.pop(client_company_location_id, None)
+        _remember_parent_company_id(
+            client_company_location_id, parent_company_id, session
+        )
+
     # Associate each child company with it's parent company.
-    for child in child_companies:
-        associate_child_to_parent(child["id"], parent_company_id, access_token, verbose)
+    await associate_children_to_parent(
+        [child["id"] for child in child_companies], parent_company_id, session
+    )
 
     return parent_company
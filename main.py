@@ -1,10 +1,18 @@
-import argparse
-import json
+import functools
 import os
+from typing import Any, Dict
 
-from dotenv import load_dotenv
+import httpx
 
-from hubspot_api import process_companies
+from hubspot_api import HUBSPOT_BASE_URL, HubspotSession, process_companies
+
+
+# Function to load the .env file, at most once per process and only when it is actually needed.
+@functools.lru_cache(maxsize=None)
+def load_env_file() -> bool:
+    from dotenv import load_dotenv
+
+    return load_dotenv()
 
 
 # Function to load the Hubspot API access token from command-line arguments or .env file.
@@ -12,7 +20,7 @@ def get_hubspot_api_access_token(cli_api_access_token: str) -> str:
     # Retrieve the Hubspot API access token from command-line arguments, .env file, or raise an error.
     if cli_api_access_token:
         return cli_api_access_token
-    load_dotenv()
+    load_env_file()
     access_token = os.getenv("HUBSPOT_API_ACCESS_TOKEN")
     if not access_token:
         raise ValueError(
@@ -22,8 +30,35 @@ def get_hubspot_api_access_token(cli_api_access_token: str) -> str:
     return access_token
 
 
+# Function to run the company processing with a single shared Hubspot API client and session.
+async def run_process_companies(
+    client_company_location_id: str, access_token: str
+) -> Dict[str, Any]:
+    # One client is reused for every request so connections are pooled rather than re-established per call.
+    # HTTP/2 lets concurrent requests share a single connection and compresses the repeated headers.
+    async with httpx.AsyncClient(
+        base_url=HUBSPOT_BASE_URL,
+        http2=True,
+        headers={
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        },
+        timeout=30.0,
+        limits=httpx.Limits(max_connections=9, max_keepalive_connections=9),
+    ) as client:
+        return await process_companies(
+            client_company_location_id, HubspotSession(client)
+        )
+
+
 # Script execution.
 if __name__ == "__main__":
+    # Script-only imports are kept here so importing this module as a library stays cheap.
+    import argparse
+    import asyncio
+    import json
+    import logging
+
     parser = argparse.ArgumentParser(description="Update Hubspot company updates.")
     parser.add_argument(
         "--parent_id", type=str, help="Client Parent Location ID.", required=True
@@ -34,14 +69,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--verbose",
         action="store_true",
-        help="Enable pretty-printing of api responses.",
+        help="Enable logging of api responses.",
     )
 
     args = parser.parse_args()
 
+    # Verbose mode only enables debug logging for the Hubspot api module, not for the http libraries beneath it.
+    logging.basicConfig(format="\n[%(levelname)s] %(message)s")
+    if args.verbose:
+        logging.getLogger("hubspot_api").setLevel(logging.DEBUG)
+
     hubspot_api_access_token = get_hubspot_api_access_token(args.api_access_token)
 
-    result = process_companies(args.parent_id, hubspot_api_access_token, args.verbose)
+    result = asyncio.run(
+        run_process_companies(args.parent_id, hubspot_api_access_token)
+    )
 
     # Always print the final result in json format.
     print(json.dumps(result, indent=2))